@@ -18,10 +18,10 @@ import datetime
 import time
 import math
 import json
+import contextlib
 from pathlib import Path
 import random
 import numpy as np
-from PIL import Image
 import torch
 import torch.nn as nn
 import torch.distributed as dist
@@ -29,12 +29,10 @@ import torch.backends.cudnn as cudnn
 import torch.nn.functional as F
 from torchvision import datasets, transforms
 from torchvision import models as torchvision_models
-import torchvision.transforms.functional as TF
 import cv2
 import utils
 import vision_transformer as vits
 from vision_transformer import DINOHead
-import threading
 
 torchvision_archs = sorted(name for name in torchvision_models.__dict__
     if name.islower() and not name.startswith("__")
@@ -78,7 +76,8 @@ def get_args_parser():
 
     # Training/Optimization parameters
     parser.add_argument('--use_fp16', type=utils.bool_flag, default=True, help="""Whether or not
-        to use half precision for training. Improves training time and memory requirements,
+        to use half precision for training (bf16 when the gpu supports it, fp16 with loss scaling
+        otherwise). Improves training time and memory requirements,
         but can provoke instability and slight decay of performance. We recommend disabling
         mixed precision if the loss is unstable, if reducing the patch size or if training with bigger ViTs.""")
     parser.add_argument('--weight_decay', type=float, default=0.04, help="""Initial value of the
@@ -91,6 +90,10 @@ def get_args_parser():
         help optimization for larger ViT architectures. 0 for disabling.""")
     parser.add_argument('--batch_size_per_gpu', default=64, type=int,
         help='Per-GPU batch-size : number of distinct images loaded on one GPU.')
+    parser.add_argument('--accum_iter', default=1, type=utils.positive_int, help="""Number of iterations
+        over which gradients are accumulated before an optimizer step. The effective batch size
+        is batch_size_per_gpu * number of gpus * accum_iter. Windows do not cross epochs,
+        the last one of an epoch may be shorter.""")
     parser.add_argument('--epochs', default=100, type=int, help='Number of epochs of training.')
     parser.add_argument('--freeze_last_layer', default=1, type=int, help="""Number of epochs
         during which we keep the output layer fixed. Typically doing so during
@@ -105,6 +108,9 @@ def get_args_parser():
     parser.add_argument('--optimizer', default='adamw', type=str,
         choices=['adamw', 'sgd', 'lars'], help="""Type of optimizer. We recommend using adamw with ViTs.""")
     parser.add_argument('--drop_path_rate', type=float, default=0.1, help="stochastic depth rate")
+    parser.add_argument('--use_compile', type=utils.bool_flag, default=False, help="""Whether or not
+        to compile the student and teacher with torch.compile. Fuses the elementwise kernels of
+        the transformer blocks, at the cost of a long compilation before the first iterations.""")
 
     # Multi-crop parameters
     parser.add_argument('--global_crops_scale', type=float, nargs='+', default=(0.4, 1.),
@@ -125,6 +131,8 @@ def get_args_parser():
     parser.add_argument('--saveckp_freq', default=20, type=int, help='Save checkpoint every x epochs.')
     parser.add_argument('--seed', default=0, type=int, help='Random seed.')
     parser.add_argument('--num_workers', default=10, type=int, help='Number of data loading workers per GPU.')
+    parser.add_argument('--prefetch_factor', default=4, type=int, help="""Number of batches loaded
+        in advance by each worker. Raise it if the gpu waits on the data loader.""")
     parser.add_argument("--dist_url", default="env://", type=str, help="""url used to set up
         distributed training; see https://pytorch.org/docs/stable/distributed.html""")
     parser.add_argument("--local_rank", default=0, type=int, help="Please ignore and do not set this argument.")
@@ -141,17 +149,13 @@ def train_dino(args):
     cudnn.benchmark = True
 
     # ============ preparing data ... ============
-    threadLock = threading.Lock()
-
     transform = DataAugmentationDINO(
         args.global_crops_scale,
         args.local_crops_scale,
         args.local_crops_number,
-        threadLock
     )
-    dataset = datasets.ImageFolder(args.data_path, transform=transform)
-    #sampler = torch.utils.data.DistributedSampler(dataset, shuffle=False)
-    sampler = torch.utils.data.SequentialSampler(dataset)
+    dataset = datasets.ImageFolder(args.data_path, transform=transform, loader=utils.tensor_loader)
+    sampler = torch.utils.data.DistributedSampler(dataset, shuffle=True)
     data_loader = torch.utils.data.DataLoader(
         dataset,
         sampler=sampler,
@@ -159,8 +163,18 @@ def train_dino(args):
         num_workers=args.num_workers,
         pin_memory=True,
         drop_last=True,
+        # keep the workers alive across epochs and let each one run a few batches ahead
+        persistent_workers=args.num_workers > 0,
+        prefetch_factor=args.prefetch_factor if args.num_workers > 0 else None,
     )
     print(f"Data loaded: there are {len(dataset)} images.")
+    # images are copied to the gpu one batch ahead and get their photometric
+    # augmentations there, on a side stream
+    prefetcher = utils.CUDAPrefetcher(
+        data_loader,
+        transform=PhotometricAugmentationDINO(args.local_crops_number),
+        memory_format=torch.channels_last_3d,
+    )
 
     # ============ building student and teacher networks ... ============
     # we changed the name DeiT-S for ViT-S to avoid confusions
@@ -198,8 +212,9 @@ def train_dino(args):
         teacher,
         DINOHead(embed_dim, args.out_dim, args.use_bn_in_head),
     )
-    # move networks to gpu
-    student, teacher = student.cuda(), teacher.cuda()
+    # move networks to gpu, channels last lets the Conv3d patch embedding use NDHWC kernels
+    student = student.cuda().to(memory_format=torch.channels_last_3d)
+    teacher = teacher.cuda().to(memory_format=torch.channels_last_3d)
     # synchronize batch norms (if any)
     if utils.has_batchnorms(student):
         student = nn.SyncBatchNorm.convert_sync_batchnorm(student)
@@ -217,6 +232,10 @@ def train_dino(args):
     # there is no backpropagation through the teacher, so no need for gradients
     for p in teacher.parameters():
         p.requires_grad = False
+    if args.use_compile:
+        # compile in place to keep the state dict keys, global and local crops need dynamic shapes
+        student.compile(mode='max-autotune', dynamic=True)
+        teacher.compile(mode='max-autotune', dynamic=True)
     print(f"Student and Teacher are built: they are both {args.arch} network.")
 
     # ============ preparing loss ... ============
@@ -232,19 +251,20 @@ def train_dino(args):
     # ============ preparing optimizer ... ============
     params_groups = utils.get_params_groups(student)
     if args.optimizer == "adamw":
-        optimizer = torch.optim.AdamW(params_groups)  # to use with ViTs
+        optimizer = torch.optim.AdamW(params_groups, fused=True)  # to use with ViTs, single fused kernel per step
     elif args.optimizer == "sgd":
         optimizer = torch.optim.SGD(params_groups, lr=0, momentum=0.9)  # lr is set by scheduler
     elif args.optimizer == "lars":
         optimizer = utils.LARS(params_groups)  # to use with convnet and large batches
-    # for mixed precision training
+    # for mixed precision training: bf16 needs no loss scaling, fp16 is used
+    # with a gradient scaler on gpus without bf16 support
     fp16_scaler = None
-    if args.use_fp16:
+    if args.use_fp16 and not torch.cuda.is_bf16_supported():
         fp16_scaler = torch.cuda.amp.GradScaler()
 
     # ============ init schedulers ... ============
     lr_schedule = utils.cosine_scheduler(
-        args.lr * (args.batch_size_per_gpu * utils.get_world_size()) / 256.,  # linear scaling rule
+        args.lr * (args.batch_size_per_gpu * utils.get_world_size() * args.accum_iter) / 256.,  # linear scaling rule
         args.min_lr,
         args.epochs, len(data_loader),
         warmup_epochs=args.warmup_epochs,
@@ -257,6 +277,9 @@ def train_dino(args):
     # momentum parameter is increased to 1. during training with a cosine schedule
     momentum_schedule = utils.cosine_scheduler(args.momentum_teacher, 1,
                                                args.epochs, len(data_loader))
+    # plain python floats are cheaper to index every iteration than numpy scalars
+    lr_schedule, wd_schedule = lr_schedule.tolist(), wd_schedule.tolist()
+    momentum_schedule = momentum_schedule.tolist()
     print(f"Loss, optimizer and schedulers ready.")
 
     # ============ optionally resume training ... ============
@@ -275,11 +298,11 @@ def train_dino(args):
     start_time = time.time()
     print("Starting DINO training !")
     for epoch in range(start_epoch, args.epochs):
-        #data_loader.sampler.set_epoch(epoch)
+        data_loader.sampler.set_epoch(epoch)
 
         # ============ training one epoch of DINO ... ============
         train_stats = train_one_epoch(student, teacher, teacher_without_ddp, dino_loss,
-            data_loader, optimizer, lr_schedule, wd_schedule, momentum_schedule,
+            prefetcher, optimizer, lr_schedule, wd_schedule, momentum_schedule,
             epoch, fp16_scaler, args)
 
         # ============ writing logs ... ============
@@ -311,57 +334,83 @@ def train_one_epoch(student, teacher, teacher_without_ddp, dino_loss, data_loade
                     fp16_scaler, args):
     metric_logger = utils.MetricLogger(delimiter="  ")
     header = 'Epoch: [{}/{}]'.format(epoch, args.epochs)
-    for it, (images, _) in enumerate(metric_logger.log_every(data_loader, 10, header)):
+    # student and teacher parameters in matching order, for the fused EMA update
+    params_q = [p.detach() for p in student.module.parameters()]
+    params_k = [p.detach() for p in teacher_without_ddp.parameters()]
+    amp_dtype = torch.bfloat16 if fp16_scaler is None else torch.float16
+    print_freq = 10
+    # losses stay on the gpu and are read back, logged and checked for nan/inf
+    # once every print_freq iterations instead of syncing with the gpu at every step
+    losses = []
+
+    def log_losses():
+        values = torch.stack(losses).tolist()
+        losses.clear()
+        for value in values:
+            if not math.isfinite(value):
+                print("Loss is {}, stopping training".format(value), force=True)
+                sys.exit(1)
+            metric_logger.update(loss=value)
+
+    for data_iter_step, (images, _) in enumerate(metric_logger.log_every(data_loader, print_freq, header)):
         # update weight decay and learning rate according to their schedule
-        it = len(data_loader) * epoch + it  # global training iteration
+        it = len(data_loader) * epoch + data_iter_step  # global training iteration
         for i, param_group in enumerate(optimizer.param_groups):
             param_group["lr"] = lr_schedule[it]
             if i == 0:  # only the first group is regularized
                 param_group["weight_decay"] = wd_schedule[it]
 
-        # move images to gpu
-        images = [im.cuda(non_blocking=True) for im in images]
-        # teacher and student forward passes + compute dino loss
-        with torch.cuda.amp.autocast(fp16_scaler is not None):
-            teacher_output = teacher(images[:2])  # only the 2 global views pass through the teacher
-            student_output = student(images)
-            loss = dino_loss(student_output, teacher_output, epoch)
-
-        if not math.isfinite(loss.item()):
-            print("Loss is {}, stopping training".format(loss.item()), force=True)
-            sys.exit(1)
-
-        # student update
-        optimizer.zero_grad()
-        param_norms = None
-        if fp16_scaler is None:
-            loss.backward()
-            if args.clip_grad:
-                param_norms = utils.clip_gradients(student, args.clip_grad)
-            utils.cancel_gradients_last_layer(epoch, student,
-                                              args.freeze_last_layer)
-            optimizer.step()
-        else:
-            fp16_scaler.scale(loss).backward()
-            if args.clip_grad:
-                fp16_scaler.unscale_(optimizer)  # unscale the gradients of optimizer's assigned params in-place
-                param_norms = utils.clip_gradients(student, args.clip_grad)
-            utils.cancel_gradients_last_layer(epoch, student,
-                                              args.freeze_last_layer)
-            fp16_scaler.step(optimizer)
-            fp16_scaler.update()
-
-        # EMA update for the teacher
-        with torch.no_grad():
-            m = momentum_schedule[it]  # momentum parameter
-            for param_q, param_k in zip(student.module.parameters(), teacher_without_ddp.parameters()):
-                param_k.data.mul_(m).add_((1 - m) * param_q.detach().data)
+        # gradients are accumulated over accum_iter micro-batches of the epoch and only
+        # all-reduced across gpus on the last one, the last window of the epoch is cut
+        # short so that no gradient leaks into the next epoch or a checkpoint
+        window_start = data_iter_step - data_iter_step % args.accum_iter
+        accum_steps = min(args.accum_iter, len(data_loader) - window_start)
+        update_step = data_iter_step + 1 == window_start + accum_steps
+        with contextlib.nullcontext() if update_step else student.no_sync():
+            # teacher and student forward passes + compute dino loss
+            with torch.cuda.amp.autocast(enabled=args.use_fp16, dtype=amp_dtype):
+                teacher_output = teacher(images[:2])  # only the 2 global views pass through the teacher
+                student_output = student(images)
+                loss = dino_loss(student_output, teacher_output, epoch)
+
+            if fp16_scaler is None:
+                (loss / accum_steps).backward()
+            else:
+                fp16_scaler.scale(loss / accum_steps).backward()
+
+        if update_step:
+            # student update
+            param_norms = None
+            if fp16_scaler is None:
+                if args.clip_grad:
+                    param_norms = utils.clip_gradients(student, args.clip_grad)
+                utils.cancel_gradients_last_layer(epoch, student,
+                                                  args.freeze_last_layer)
+                optimizer.step()
+            else:
+                if args.clip_grad:
+                    fp16_scaler.unscale_(optimizer)  # unscale the gradients of optimizer's assigned params in-place
+                    param_norms = utils.clip_gradients(student, args.clip_grad)
+                utils.cancel_gradients_last_layer(epoch, student,
+                                                  args.freeze_last_layer)
+                fp16_scaler.step(optimizer)
+                fp16_scaler.update()
+            optimizer.zero_grad(set_to_none=True)
+
+            # EMA update for the teacher
+            with torch.no_grad():
+                m = momentum_schedule[it]  # momentum parameter
+                torch._foreach_mul_(params_k, m)
+                torch._foreach_add_(params_k, params_q, alpha=1 - m)
 
         # logging
-        torch.cuda.synchronize()
-        metric_logger.update(loss=loss.item())
+        losses.append(loss.detach())
+        if len(losses) == print_freq:
+            log_losses()
         metric_logger.update(lr=optimizer.param_groups[0]["lr"])
         metric_logger.update(wd=optimizer.param_groups[0]["weight_decay"])
+    if losses:
+        log_losses()
     # gather the stats from all processes
     metric_logger.synchronize_between_processes()
     print("Averaged stats:", metric_logger)
@@ -379,11 +428,13 @@ class DINOLoss(nn.Module):
         self.register_buffer("center", torch.zeros(1, out_dim))
         # we apply a warm up for the teacher temperature because
         # a too high temperature makes the training instable at the beginning
-        self.teacher_temp_schedule = np.concatenate((
+        self.register_buffer("teacher_temp_schedule", torch.from_numpy(np.concatenate((
             np.linspace(warmup_teacher_temp,
                         teacher_temp, warmup_teacher_temp_epochs),
             np.ones(nepochs - warmup_teacher_temp_epochs) * teacher_temp
-        ))
+        ))).float(), persistent=False)
+        # the temperature only changes once per epoch: read it back to the host once
+        self._cached_epoch, self._cached_temp = None, None
 
     def forward(self, student_output, teacher_output, epoch):
         """
@@ -393,21 +444,20 @@ class DINOLoss(nn.Module):
         student_out = student_out.chunk(self.ncrops)
 
         # teacher centering and sharpening
-        temp = self.teacher_temp_schedule[epoch]
+        if epoch != self._cached_epoch:
+            self._cached_epoch, self._cached_temp = epoch, self.teacher_temp_schedule[epoch].item()
+        temp = self._cached_temp
         teacher_out = F.softmax((teacher_output - self.center) / temp, dim=-1)
         teacher_out = teacher_out.detach().chunk(2)
 
-        total_loss = 0
-        n_loss_terms = 0
-        for iq, q in enumerate(teacher_out):
-            for v in range(len(student_out)):
-                if v == iq:
-                    # we skip cases where student and teacher operate on the same view
-                    continue
-                loss = torch.sum(-q * F.log_softmax(student_out[v], dim=-1), dim=-1)
-                total_loss += loss.mean()
-                n_loss_terms += 1
-        total_loss /= n_loss_terms
+        # cross-entropy of every (teacher view, student view) pair at once
+        q = torch.stack(teacher_out)  # (2, B, D)
+        s = F.log_softmax(torch.stack(student_out), dim=-1)  # (V, B, D)
+        with torch.cuda.amp.autocast(enabled=False):  # keep the reduction in fp32
+            loss = -torch.einsum('qbd,vbd->qv', q.float(), s.float()) / q.shape[1]
+        # we skip cases where student and teacher operate on the same view
+        same_view = torch.eye(*loss.shape, dtype=torch.bool, device=loss.device)
+        total_loss = loss.masked_fill(same_view, 0).sum() / (loss.numel() - len(q))
         self.update_center(teacher_output)
         return total_loss
 
@@ -425,381 +475,118 @@ class DINOLoss(nn.Module):
 
 
 class DataAugmentationDINO(object):
-    def __init__(self, global_crops_scale, local_crops_scale, local_crops_number,threadLock):
+    def __init__(self, global_crops_scale, local_crops_scale, local_crops_number):
         self.global_crops_scale = global_crops_scale
         self.local_crops_scale = local_crops_scale
         self.local_crops_number = local_crops_number
 
-
-        self.threadLock = threadLock
-        flip_and_color_jitter = transforms.Compose([
-            transforms.RandomHorizontalFlip(p=0.5),
-            transforms.RandomApply(
-                [transforms.ColorJitter(brightness=0.4, contrast=0.4, saturation=0.2, hue=0.1)],
-                p=0.8
-            ),
-            transforms.RandomGrayscale(p=0.2),
-        ])
-        normalize = transforms.Compose([
-            transforms.ToTensor(),
-            transforms.Normalize((0.485, 0.456, 0.406), (0.229, 0.224, 0.225)),
-        ])
-
-        # first global crop
-        self.global_transfo1 = transforms.Compose([
-            transforms.RandomResizedCrop(224, scale=global_crops_scale, interpolation=Image.BICUBIC),
-            flip_and_color_jitter,
-            utils.GaussianBlur(1.0),
-            normalize,
-        ])
-        # second global crop
-        self.global_transfo2 = transforms.Compose([
-            transforms.RandomResizedCrop(224, scale=global_crops_scale, interpolation=Image.BICUBIC),
-            flip_and_color_jitter,
-            utils.GaussianBlur(0.1),
-            utils.Solarization(0.2),
-            normalize,
-        ])
-        # transformation for the local small crops
-        self.local_crops_number = local_crops_number
-        self.local_transfo = transforms.Compose([
-            transforms.RandomResizedCrop(96, scale=local_crops_scale, interpolation=Image.BICUBIC),
-            flip_and_color_jitter,
-            utils.GaussianBlur(p=0.5),
-            normalize,
-        ])
+        # the transforms are stateless, build them once instead of once per image
+        self.Gt1 = Global_transfo()
 
 
     def __call__(self, image):
-        #print(image.size)
-        if(image.size != (640,1920)):
+        if(image.shape[-2:] != (1920,640)):
             print("ERROR!")
-        def crop(im, height, width):
-            imgwidth, imgheight = im.size
-            k = 0
-            out = []
-            for i in range(0, imgheight, height):
-                for j in range(0, imgwidth, width):
-                    box = (j, i, j + width, i + height)
-                    out.append(im.crop(box))
-                    k += 1
-            return out
-
-        images = crop(image,480,640)
+        # the clip is stored as a vertical strip of 4 frames of 480x640:
+        # view it as a (4, C, 480, 640) stack without copying
+        images = image.view(3, 4, 480, 640).transpose(0, 1)
 
         crops = []
-
-        #crops.append(self.global_transfo1(image))
-
-        Gt1  = Global_transfo(self.threadLock)
-        tf1 = Gt1.transfo1(images, self.global_crops_scale)
-        i = 0
-        crops.append(tf1)
-
-        for obj in tf1:
-
-            # obj.save(f"image{i}.jpg")
-            i += 1
-
-
-        tf2 = Gt1.transfo2(images, self.global_crops_scale)
-        crops.append(tf2)
-
-        for obj in tf2:
-
-            # obj.save(f"image{i}.jpg")
-            i += 1
-
-
-
-
-
+        crops.append(self.Gt1.transfo1(images, self.global_crops_scale))
+        crops.append(self.Gt1.transfo2(images, self.global_crops_scale))
         for _ in range(self.local_crops_number):
-            tf_local = Gt1.local_transfo(images, self.local_crops_scale)
-            """
-            for j in range(len(tf_local)):
-                tf_local[j].save(f"image{i}.jpg")
-                i += 1
-            """
-            crops.append(tf_local)
-
-        a = 0
+            crops.append(self.Gt1.local_transfo(images, self.local_crops_scale))
         return crops
 
 
 
 class Global_transfo():
-    def __init__(self, threadLock):
-        self.threadLock = threadLock
-
-    def transfo2(self,images, global_crops_scale):
-        # load image with index from self.left_image_paths
-
+    """
+    Geometric multi-frame augmentations, run in the data loader workers. The frames
+    of a clip come as a single (N, C, H, W) uint8 tensor and every random
+    transformation is drawn once and applied to the whole stack, so that all the
+    frames share the same parameters. The photometric part runs on the gpu, see
+    PhotometricAugmentationDINO.
+    """
+    def transfo1(self, frames, global_crops_scale):
+        return self._transfo(frames, 224, global_crops_scale)
+
+    def transfo2(self, frames, global_crops_scale):
+        return self._transfo(frames, 224, global_crops_scale)
+
+    def local_transfo(self, frames, local_crops_scale):
+        return self._transfo(frames, 96, local_crops_scale)
+
+    def _transfo(self, frames, size, crops_scale):
+        """
+        Crop, resize and flip a (N, C, H, W) uint8 stack of frames into a
+        (C, N, size, size) uint8 clip.
+        """
         # Random crop
-        i, j, h, w = transforms.RandomResizedCrop.get_params(
-            images[0], scale=global_crops_scale,ratio=[0.999,1.001] )
-        for x in range(len(images)):
-            img_c = TF.crop(images[x], i, j, h, w)
-            images[x] = img_c.resize((224,224))
+        i, j, h, w = utils.square_crop_params(frames.shape[-2], frames.shape[-1], crops_scale)
+        # the crop is a view, bilinear resize of uint8 has a native cpu kernel (no float round trip)
+        frames = F.interpolate(frames[..., i:i + h, j:j + w], size=(size, size),
+                               mode='bilinear', align_corners=False, antialias=True)
 
         # Random horizontal flipping
         if random.random() > 0.5:
-            for i in range(len(images)):
-                images[i] = TF.hflip(images[i])
+            frames = frames.flip(-1)
 
         # Random vertical flipping
         if random.random() > 0.5:
-            for i in range(len(images)):
-                images[i] = TF.vflip(images[i])
-
-        # jitter
-        color_jitter = transforms.ColorJitter(brightness=0.4, contrast=0.4, saturation=0.2, hue=0.1)
-        fn_idx, brightness_factor, contrast_factor, saturation_factor, hue_factor = transforms.ColorJitter.get_params(color_jitter.brightness, color_jitter.contrast, color_jitter.saturation,color_jitter.hue)
-
-        for i in range(len(images)):
-            img = images[i]
-
-            for fn_id in fn_idx:
-                if fn_id == 0 and brightness_factor is not None:
-                    img = TF.adjust_brightness(img, brightness_factor)
-                elif fn_id == 1 and contrast_factor is not None:
-                    img = TF.adjust_contrast(img, contrast_factor)
-                elif fn_id == 2 and saturation_factor is not None:
-                    img = TF.adjust_saturation(img, saturation_factor)
-                elif fn_id == 3 and hue_factor is not None:
-                    img = TF.adjust_hue(img, hue_factor)
-
-            images[i] = img
-
-
-        do_it = False
-        p = random.random()
-        #print(p)
-        if(p >= 0.1):
-            do_it = True
-
-        transform_GB = transforms.Compose([utils.GaussianBlur(do_it,p=p )])
-
-
-        images = transform_GB(images)
-
+            frames = frames.flip(-2)
 
-        #self.threadLock.acquire()
-        rnd = random.randint(1,100000)
-
-        # for i in range(len(images)):
-            # images[i].save(f"image{rnd}_{i}.jpg")
-        #self.threadLock.release()
-
-        # images solarization
-        do_it = False
-        p = random.random()
-        #print(p)
-        if(p >= 0.2):
-            do_it = True
-
-        transform_GB = transforms.Compose([utils.Solarization(do_it)])
-        images = transform_GB(images)
-
-        # to tensor
-
-        ToTensor = transforms.Compose([
-            transforms.ToTensor()
-        ])
-        # TODO return torchTensor
-
-        for i in range(len(images)):
-            images[i] = ToTensor(images[i])
-
-
-        # normal
-        normalize = transforms.Compose([
-            transforms.Normalize((0.485, 0.456, 0.406), (0.229, 0.224, 0.225)),
-        ])
-        for i in range(len(images)):
-            images[i] = normalize(images[i])
-        
-
-
-        # concat
-        torchTensor = images[0]
-        torchTensor = torchTensor[0:,None,:]
-
-        for i in range(1,len(images)):
-            torchTensor = torch.cat(((images[i])[0:,None,:],torchTensor),1)
-
-
-        # TODO return torchTensor
+        # concat along a new time dimension, last frame first: (C, N, H, W)
+        # in a single allocation
+        torchTensor = torch.stack(frames.unbind(0)[::-1], dim=1)
         return torchTensor
 
-    def transfo1(self, images, global_crops_scale):
-        # load image with index from self.left_image_paths
-
-        # Random crop
-        i, j, h, w = transforms.RandomResizedCrop.get_params(
-            images[0], scale=global_crops_scale,ratio=[0.999,1.001] )
-        for x in range(len(images)):
-            img_c = TF.crop(images[x], i, j, h, w)
-            images[x] = img_c.resize((224,224))
-
-        # Random horizontal flipping
-        if random.random() > 0.5:
-            for i in range(len(images)):
-                images[i] = TF.hflip(images[i])
 
-        # Random vertical flipping
-        if random.random() > 0.5:
-            for i in range(len(images)):
-                images[i] = TF.vflip(images[i])
+class PhotometricAugmentationDINO(object):
+    """
+    Photometric part of the DINO augmentations, applied on the gpu to the list of
+    (B, C, N, H, W) uint8 clip batches of every view: color jitter, gaussian blur,
+    solarization and normalization. Every sample draws its own parameters and its
+    own jitter order, shared by all the frames of its clip.
+    """
+    def __init__(self, local_crops_number):
+        self.color_jitter = transforms.ColorJitter(brightness=0.4, contrast=0.4, saturation=0.2, hue=0.1)
+        # per view blur and solarization, in the order of DataAugmentationDINO's crops
+        self.blur = [utils.GaussianBlur(p=0.5), utils.GaussianBlur(p=0.9)] + \
+                    [utils.GaussianBlur(p=0.5)] * local_crops_number
+        self.solarization = [None, utils.Solarization(p=0.8)] + [None] * local_crops_number
+        # normalization folded into a single multiply-add: (x - mean) / std = x * scale + shift
+        mean = torch.tensor((0.485, 0.456, 0.406), device='cuda').view(1, 1, 3, 1, 1)
+        std = torch.tensor((0.229, 0.224, 0.225), device='cuda').view(1, 1, 3, 1, 1)
+        self.scale, self.shift = 1 / std, -mean / std
+
+    def __call__(self, images):
+        return [self.augment(clips, blur, solarization)
+                for clips, blur, solarization in zip(images, self.blur, self.solarization)]
+
+    def augment(self, clips, blur, solarization):
+        # to float, as (B, N, C, H, W) frames so that the channels are at dim -3
+        frames = clips.transpose(1, 2).float().div_(255)
 
         # jitter
-        color_jitter = transforms.ColorJitter(brightness=0.4, contrast=0.4, saturation=0.2, hue=0.1)
-        fn_idx, brightness_factor, contrast_factor, saturation_factor, hue_factor = transforms.ColorJitter.get_params(
-            color_jitter.brightness, color_jitter.contrast, color_jitter.saturation, color_jitter.hue)
-
-        for i in range(len(images)):
-            img = images[i]
-
-            for fn_id in fn_idx:
-                if fn_id == 0 and brightness_factor is not None:
-                    img = TF.adjust_brightness(img, brightness_factor)
-                elif fn_id == 1 and contrast_factor is not None:
-                    img = TF.adjust_contrast(img, contrast_factor)
-                elif fn_id == 2 and saturation_factor is not None:
-                    img = TF.adjust_saturation(img, saturation_factor)
-                elif fn_id == 3 and hue_factor is not None:
-                    img = TF.adjust_hue(img, hue_factor)
-
-            images[i] = img
-
-        do_it = False
-        p = random.random()
-        #print(p)
-        if (p >= 0.5):
-            do_it = True
-
-        transform_GB = transforms.Compose([utils.GaussianBlur(do_it, p=p)])
-
-        images = transform_GB(images)
-
-        # self.threadLock.acquire()
-        rnd = random.randint(1, 100000)
-        # for i in range(len(images)):
-            # images[i].save(f"image{rnd}_{i}.jpg")
-        # self.threadLock.release()
-
-        # to tensor
-        ToTensor = transforms.Compose([
-            transforms.ToTensor()
-        ])
-        # TODO return torchTensor
-
-        for i in range(len(images)):
-            images[i] = ToTensor(images[i])
-            pass
-        # normal
-        normalize = transforms.Compose([
-            transforms.Normalize((0.485, 0.456, 0.406), (0.229, 0.224, 0.225)),
-        ])
-        for i in range(len(images)):
-            images[i] = normalize(images[i])
-
-        # concat
-        torchTensor = images[0]
-        torchTensor = torchTensor[0:,None,:]
-
-        for i in range(1,len(images)):
-            torchTensor = torch.cat(((images[i])[0:,None,:],torchTensor),1)
-        
-
-        # TODO return torchTensor
-        return torchTensor
-
-    def local_transfo(self, images, local_crops_scale):
-        # load image with index from self.left_image_paths
-
-        # Random crop
-        i, j, h, w = transforms.RandomResizedCrop.get_params(
-            images[0], scale=local_crops_scale,ratio=[0.999,1.001] )
-        for x in range(len(images)):
-            img_c = TF.crop(images[x], i, j, h, w)
-            images[x] = img_c.resize((96,96))
+        def factor(bounds):
+            return torch.empty((len(frames), 1, 1, 1, 1), device=frames.device).uniform_(*bounds)
+        color_jitter = self.color_jitter
+        fn_idx = torch.rand((len(frames), 4), device=frames.device).argsort(dim=1)
+        frames = utils.color_jitter_(frames, fn_idx,
+                                     factor(color_jitter.brightness), factor(color_jitter.contrast),
+                                     factor(color_jitter.saturation), factor(color_jitter.hue))
 
-        # Random horizontal flipping
-        if random.random() > 0.5:
-            for i in range(len(images)):
-                images[i] = TF.hflip(images[i])
+        # gaussian blur
+        frames = blur(frames)
 
-        # Random vertical flipping
-        if random.random() > 0.5:
-            for i in range(len(images)):
-                images[i] = TF.vflip(images[i])
+        # images solarization
+        if solarization is not None:
+            frames = solarization(frames)
 
-        # jitter
-        color_jitter = transforms.ColorJitter(brightness=0.4, contrast=0.4, saturation=0.2, hue=0.1)
-        fn_idx, brightness_factor, contrast_factor, saturation_factor, hue_factor = transforms.ColorJitter.get_params(
-            color_jitter.brightness, color_jitter.contrast, color_jitter.saturation, color_jitter.hue)
-
-        for i in range(len(images)):
-            img = images[i]
-
-            for fn_id in fn_idx:
-                if fn_id == 0 and brightness_factor is not None:
-                    img = TF.adjust_brightness(img, brightness_factor)
-                elif fn_id == 1 and contrast_factor is not None:
-                    img = TF.adjust_contrast(img, contrast_factor)
-                elif fn_id == 2 and saturation_factor is not None:
-                    img = TF.adjust_saturation(img, saturation_factor)
-                elif fn_id == 3 and hue_factor is not None:
-                    img = TF.adjust_hue(img, hue_factor)
-
-            images[i] = img
-
-        do_it = False
-        p = random.random()
-        #print(p)
-        if (p >= 0.5):
-            do_it = True
-
-        transform_GB = transforms.Compose([utils.GaussianBlur(do_it, p=p)])
-
-        images = transform_GB(images)
-
-        # self.threadLock.acquire()
-        rnd = random.randint(1, 100000)
-        # for i in range(len(images)):
-            # images[i].save(f"image{rnd}_{i}.jpg")
-        # self.threadLock.release()
-
-        # to tensor
-        ToTensor = transforms.Compose([
-            transforms.ToTensor()
-        ])
-        # TODO return torchTensor
-
-        for i in range(len(images)):
-            images[i] = ToTensor(images[i])
-            pass
-
-        # normal
-        normalize = transforms.Compose([
-            transforms.Normalize((0.485, 0.456, 0.406), (0.229, 0.224, 0.225)),
-        ])
-        for i in range(len(images)):
-            images[i] = normalize(images[i])
-
-        # concat
-        torchTensor = images[0]
-        torchTensor = torchTensor[0:,None,:]
-
-        for i in range(1,len(images)):
-            torchTensor = torch.cat(((images[i])[0:,None,:],torchTensor),1)
-
-        # TODO return torchTensor
-        return torchTensor
+        # normal, back to (B, C, N, H, W)
+        return torch.addcmul(self.shift, frames, self.scale).transpose(1, 2)
 
-def __len__(self):
-    return len(self.image_left_paths)
 
 if __name__ == '__main__':
     
@@ -30,62 +30,152 @@ import numpy as np
 import torch
 from torch import nn
 import torch.distributed as dist
-from PIL import ImageFilter, ImageOps
+import torchvision
+import torchvision.transforms.functional as TF
 
 
 class GaussianBlur(object):
     """
-    Apply Gaussian Blur to the PIL image.
+    Apply Gaussian Blur to a (B, ..., C, H, W) batch of float image tensors.
+    Each sample is blurred with probability p, with its own radius.
     """
-    def __init__(self, do_it = None, p=0.5, radius_min=0.1, radius_max=2.):
+    def __init__(self, p=0.5, radius_min=0.1, radius_max=2.):
         self.prob = p
         self.radius_min = radius_min
         self.radius_max = radius_max
-        self.do_it = do_it
 
     def __call__(self, imgs):
-        res_img = []
-        #self.do_it = random.random() <= self.prob
+        B, H, W = len(imgs), imgs.shape[-2], imgs.shape[-1]
+        radius = torch.empty(B, 1, device=imgs.device).uniform_(self.radius_min, self.radius_max)
+        do_it = torch.rand(B, 1, device=imgs.device) < self.prob
+
+        # PIL's radius is the standard deviation, cover +/- 3 sigma of the largest radius
+        half = math.ceil(3 * self.radius_max)
+        x = torch.arange(-half, half + 1, dtype=imgs.dtype, device=imgs.device)
+        kernel = torch.exp(-x ** 2 / (2 * radius ** 2))
+        kernel = kernel / kernel.sum(dim=1, keepdim=True)
+        # samples that are not blurred get an identity kernel
+        kernel = torch.where(do_it, kernel, (x == 0).to(imgs.dtype))
+
+        # the gaussian is separable: a horizontal then a vertical depthwise 1D convolution,
+        # with every image plane of the batch as its own group
+        planes = imgs.reshape(1, -1, H, W)
+        kernel = kernel.repeat_interleave(planes.shape[1] // B, dim=0)
+        planes = nn.functional.pad(planes, (half, half, half, half), mode="reflect")
+        planes = nn.functional.conv2d(planes, kernel.view(-1, 1, 1, 2 * half + 1), groups=kernel.shape[0])
+        planes = nn.functional.conv2d(planes, kernel.view(-1, 1, 2 * half + 1, 1), groups=kernel.shape[0])
+        return planes.view(imgs.shape)
 
 
-        if not self.do_it:
-            # print("not blured")
-            for img in imgs:
-                res_img.append(img)
+class Solarization(object):
+    """
+    Apply Solarization to a (B, ..., C, H, W) batch of float image tensors in [0, 1].
+    Each sample is solarized with probability p.
+    """
+    def __init__(self, p=0.2):
+        self.prob = p
+
+    def __call__(self, imgs):
+        do_it = torch.rand((len(imgs),) + (1,) * (imgs.ndim - 1), device=imgs.device) < self.prob
+        # same threshold as PIL's ImageOps.solarize
+        return torch.where(do_it & (imgs >= 128 / 255), 1 - imgs, imgs)
 
-        if self.do_it:
-            # print("blured")
-            radius = random.uniform(self.radius_min, self.radius_max)
-            for img in imgs:
-                res_img.append(img.filter(
-                ImageFilter.GaussianBlur(
-                    radius=radius
-                )
-            ))
 
-        return res_img
+def adjust_brightness_(imgs, factor):
+    """
+    In-place brightness jitter of a (..., 3, H, W) float stack in [0, 1].
+    factor is a float or a tensor broadcastable to imgs.
+    """
+    return imgs.mul_(factor).clamp_(0, 1)
 
 
-class Solarization(object):
+def adjust_contrast_(imgs, factor):
     """
-    Apply Solarization to the PIL image.
+    In-place contrast jitter of a (..., 3, H, W) float stack in [0, 1],
+    blending each frame with its mean gray level.
     """
-    def __init__(self, do_it = None):
-        self.do_it = do_it
+    mean = TF.rgb_to_grayscale(imgs).mean(dim=(-3, -2, -1), keepdim=True)
+    return imgs.mul_(factor).add_(mean * (1 - factor)).clamp_(0, 1)
 
-    def __call__(self, imgs):
-        res_img = []
-        if not self.do_it:
-            # print("not solarized")
-            for img in imgs:
-                res_img.append(img)
 
-        if self.do_it:
-            # print("blured")
-            for img in imgs:
-                res_img.append(ImageOps.solarize(img))
+def adjust_saturation_(imgs, factor):
+    """
+    In-place saturation jitter of a (..., 3, H, W) float stack in [0, 1],
+    blending each frame with its grayscale version.
+    """
+    gray = TF.rgb_to_grayscale(imgs)
+    return imgs.mul_(factor).add_(gray * (1 - factor)).clamp_(0, 1)
+
+
+# the inverse is computed rather than rounded, so that a zero hue factor is a no-op
+_RGB_TO_YIQ = ((0.299, 0.587, 0.114), (0.596, -0.274, -0.322), (0.211, -0.523, 0.312))
+_YIQ_TO_RGB = torch.linalg.inv(torch.tensor(_RGB_TO_YIQ, dtype=torch.float64)).tolist()
+
+
+def adjust_hue_(imgs, factor):
+    """
+    In-place hue jitter of a (..., 3, H, W) float stack in [0, 1]: the chroma is
+    rotated by factor * 360 degrees in YIQ space. Unlike the HSV round trip of
+    TF.adjust_hue, this is linear and takes a per-sample factor tensor.
+    """
+    theta = torch.as_tensor(factor, dtype=imgs.dtype, device=imgs.device) * (2 * math.pi)
+    cos, sin = theta.cos(), theta.sin()
+    r, g, b = imgs.split(1, dim=-3)
+    y, i, q = (cr * r + cg * g + cb * b for cr, cg, cb in _RGB_TO_YIQ)
+    i, q = i * cos - q * sin, i * sin + q * cos
+    rgb = torch.cat([cy * y + ci * i + cq * q for cy, ci, cq in _YIQ_TO_RGB], dim=-3)
+    return imgs.copy_(rgb).clamp_(0, 1)
+
 
-        return res_img
+# indexed by the fn_idx drawn by transforms.ColorJitter.get_params,
+# with the factor for which each op leaves the images unchanged
+JITTER_FNS = (adjust_brightness_, adjust_contrast_, adjust_saturation_, adjust_hue_)
+JITTER_IDENTITY = (1., 1., 1., 0.)
+
+
+def color_jitter_(imgs, fn_idx, *factors):
+    """
+    Apply the jitter drawn by transforms.ColorJitter.get_params to a whole
+    (B, ..., 3, H, W) float stack, in the drawn order. Factors set to None are skipped.
+    fn_idx can also be a (B, 4) tensor holding one order per sample: every step then
+    runs each op on the whole batch, with an identity factor for the samples that
+    apply another op at that step.
+    """
+    if not torch.is_tensor(fn_idx):
+        for fn_id in fn_idx:
+            if factors[fn_id] is not None:
+                imgs = JITTER_FNS[fn_id](imgs, factors[fn_id])
+        return imgs
+    shape = (len(imgs),) + (1,) * (imgs.ndim - 1)
+    for step in fn_idx.unbind(1):
+        for fn_id, (fn, factor, identity) in enumerate(zip(JITTER_FNS, factors, JITTER_IDENTITY)):
+            if factor is not None:
+                imgs = fn(imgs, torch.where((step == fn_id).view(shape), factor, identity))
+    return imgs
+
+
+def square_crop_params(height, width, scale):
+    """
+    Sample (top, left, height, width) of a random square crop covering a fraction
+    `scale` of the image area. Drawn in closed form instead of RandomResizedCrop's
+    rejection sampling: the scale range is clipped to the largest square that fits,
+    which is the distribution of the accepted draws.
+    """
+    max_scale = min(height, width) ** 2 / (height * width)
+    area = random.uniform(scale[0], min(scale[1], max_scale)) * height * width
+    side = min(int(round(math.sqrt(area))), height, width)
+    i = random.randint(0, height - side)
+    j = random.randint(0, width - side)
+    return i, j, side, side
+
+
+def tensor_loader(path):
+    """
+    Decode an image file straight into a (3, H, W) uint8 RGB tensor.
+    torchvision.io decodes with libjpeg-turbo and skips the PIL round trip.
+    """
+    data = torchvision.io.read_file(path)
+    return torchvision.io.decode_image(data, mode=torchvision.io.ImageReadMode.RGB)
 
 
 def load_pretrained_weights(model, pretrained_weights, checkpoint_key, model_name, patch_size):
@@ -150,14 +240,12 @@ def load_pretrained_linear_weights(linear_classifier, model_name, patch_size):
 
 
 def clip_gradients(model, clip):
-    norms = []
-    for name, p in model.named_parameters():
-        if p.grad is not None:
-            param_norm = p.grad.data.norm(2)
-            norms.append(param_norm.item())
-            clip_coef = clip / (param_norm + 1e-6)
-            if clip_coef < 1:
-                p.grad.data.mul_(clip_coef)
+    # clip the gradient norm of each parameter without any host sync: the norms come
+    # from one multi-tensor kernel, the rescale by 0-d coefficients runs per tensor
+    grads = [p.grad for p in model.parameters() if p.grad is not None]
+    norms = torch._foreach_norm(grads)
+    clip_coefs = (clip / (torch.stack(norms) + 1e-6)).clamp_(max=1)
+    torch._foreach_mul_(grads, clip_coefs.unbind())
     return norms
 
 
@@ -232,6 +320,16 @@ def bool_flag(s):
         raise argparse.ArgumentTypeError("invalid value for a boolean flag")
 
 
+def positive_int(s):
+    """
+    Parse strictly positive integer arguments from the command line.
+    """
+    value = int(s)
+    if value < 1:
+        raise argparse.ArgumentTypeError("expected a positive integer, got {}".format(s))
+    return value
+
+
 def fix_random_seeds(seed=31):
     """
     Fix random seeds.
@@ -420,6 +518,43 @@ class MetricLogger(object):
             header, total_time_str, total_time / len(iterable)))
 
 
+class CUDAPrefetcher(object):
+    """
+    Wrap a data loader yielding (list of image tensors, target) batches and copy
+    the images of the next batch to the gpu on a side stream, so that the host to
+    device transfer overlaps with the computation on the current batch. An optional
+    transform is applied to the list of gpu images on the same side stream.
+    """
+    def __init__(self, loader, transform=None, memory_format=torch.contiguous_format):
+        self.loader = loader
+        self.transform = transform
+        self.memory_format = memory_format
+        self.stream = torch.cuda.Stream()
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        first = True
+        for next_images, next_target in self.loader:
+            with torch.cuda.stream(self.stream):
+                next_images = [im.cuda(non_blocking=True) for im in next_images]
+                if self.transform is not None:
+                    next_images = self.transform(next_images)
+                next_images = [im.contiguous(memory_format=self.memory_format) for im in next_images]
+            if not first:
+                yield images, target
+            first = False
+            # make the compute stream wait for the copy, and tell the caching allocator
+            # that these tensors are now used on the compute stream
+            torch.cuda.current_stream().wait_stream(self.stream)
+            for im in next_images:
+                im.record_stream(torch.cuda.current_stream())
+            images, target = next_images, next_target
+        if not first:
+            yield images, target
+
+
 def get_sha():
     cwd = os.path.dirname(os.path.abspath(__file__))
 